@@ -12,20 +12,29 @@
 #Twitter: https://twitter.com/avieloss
 
 import asyncio
-import subprocess
-import csv
+import contextlib
 import json
 import argparse
+import itertools
 import re
 import logging
+import os
 import signal
+import time
+from collections import deque
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Set, Dict, List, Any
+from typing import Optional, Dict, Deque, Any, NamedTuple, Tuple
 
 from aiohttp import web
 import websockets
 
+try:
+    import orjson  # optional, much faster JSON encoding
+except ImportError:
+    orjson = None
+
 # ================= ARGUMENTS =================
 
 parser = argparse.ArgumentParser(description="P2000 FLEX monitor (asyncio)")
@@ -47,46 +56,125 @@ HTTP_PORT = 8112
 WS_PORT = 8113
 RETENTION_DAYS = 3
 MAX_MESSAGES = 10000  # Prevent memory issues
-HISTORY_SAVE_INTERVAL = 30  # Save history every 30 seconds instead of every message
+RTL_FM_CMD = ["rtl_fm", "-f", "169.65M", "-M", "fm", "-s", "22050", "-p", "83", "-g", "30"]
+MULTIMON_CMD = ["multimon-ng", "-a", "FLEX", "-t", "raw", "-"]
+DECODER_READ_LIMIT = 1 << 16  # StreamReader buffer and read size for multimon-ng output
+CLIENT_QUEUE_SIZE = 100  # Pending broadcasts per WebSocket client before it is dropped
+HISTORY_PAGE_SIZE = 200  # Messages embedded in the page / returned per /history call
+HISTORY_SAVE_INTERVAL = 30  # Compact the history file at most once per 30 seconds
+HISTORY_COMPACT_LINES = MAX_MESSAGES // 2  # Stale lines in the history file before compacting
 
 BASE_DIR = Path(__file__).parent
 CAPCODE_FILE = BASE_DIR / "capcodelijst.csv"
-DB_FILE = BASE_DIR / "p2000_history.json"
+DB_FILE = BASE_DIR / "p2000_history.jsonl"
+LEGACY_DB_FILE = BASE_DIR / "p2000_history.json"
+
+class Message(NamedTuple):
+    """One decoded message; a tuple keeps up to MAX_MESSAGES of them compact."""
+    time_local: str
+    time_utc: str
+    ts: float  # epoch seconds, cheap to compare when pruning
+    prio: str
+    type: str
+    text: str
+    caps_raw: str = ""
+    capcodes_named: Optional[str] = None  # pre-rendered HTML in older history files
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Message":
+        """Build a message from a history entry, filling in fields older files lack."""
+        return cls(
+            time_local=d["time_local"],
+            time_utc=d["time_utc"],
+            ts=d["ts"] if "ts" in d else datetime.fromisoformat(d["time_utc"]).timestamp(),
+            prio=d["prio"] if "prio" in d else extract_prio(d.get("text", "")),
+            type=d["type"],
+            text=d["text"],
+            caps_raw=d.get("caps_raw", ""),
+            capcodes_named=d.get("capcodes_named"),
+        )
 
-messages: List[Dict[str, Any]] = []
-clients: Set[websockets.WebSocketServerProtocol] = set()
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the message as stored in the history file."""
+        d = self._asdict()
+        if self.capcodes_named is None:
+            del d["capcodes_named"]
+        return d
+
+# Newest first; maxlen drops the oldest message when full
+messages: Deque[Message] = deque(maxlen=MAX_MESSAGES)
+# Each client has its own outgoing queue, drained by a writer task. The entry
+# is removed when the writer stops, the connection closes or broadcast() drops
+# the client; the writer is cancelled in the last two cases.
+clients: Dict[websockets.WebSocketServerProtocol, Tuple[asyncio.Queue, asyncio.Task]] = {}
 capcodes: Dict[str, Dict[str, str]] = {}
 shutdown_event = asyncio.Event()
+history_dirty = asyncio.Event()
+history_lock = asyncio.Lock()
+# Lines in the history file whose message is no longer in memory
+history_stale = 0
 
 # ================= HELPERS =================
 
+# One shared compact encoder: no indentation or padding on disk or on the wire
+if orjson is not None:
+    def _encode_json_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def _encode_json(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    _encode_json = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+    def _encode_json_bytes(obj: Any) -> bytes:
+        return _encode_json(obj).encode("utf-8")
+
+_PRIO_RE = re.compile(r"\b(A0|A1|A2|B1|B2|P\s*1|TEST)\b", re.IGNORECASE)
+
 def extract_prio(text: str) -> str:
-    m = re.search(r"\b(A0|A1|A2|B1|B2|P\s*1|TEST)\b", text, re.I)
+    m = _PRIO_RE.search(text)
     return m.group(1).replace(" ", "").upper() if m else "-"
 
-def capcode_candidates(raw: str):
-    raw = raw.strip()
-    out = set()
-    if raw.isdigit() and len(raw) >= 9:
-        out.add(raw[-7:])
-    if raw.isdigit() and len(raw) == 7:
-        out.add(raw)
-        out.add(raw.zfill(7))
-    return out
-
-def prune_old_messages() -> None:
-    """Remove messages older than RETENTION_DAYS and limit total count."""
-    cutoff = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
-    messages[:] = [
-        m for m in messages
-        if datetime.fromisoformat(m["time_utc"]) >= cutoff
-    ]
-    # Also limit total messages to prevent memory issues
-    if len(messages) > MAX_MESSAGES:
-        messages[:] = messages[:MAX_MESSAGES]
+def prune_old_messages(now: Optional[float] = None) -> int:
+    """Remove messages older than RETENTION_DAYS.
+
+    `now` is the current epoch time if the caller already has it.
+    Returns the number of removed messages.
+    """
+    before = len(messages)
+    if now is None:
+        now = time.time()
+    cutoff = now - timedelta(days=RETENTION_DAYS).total_seconds()
+    # Messages are ordered newest first, so expired ones are at the tail
+    while messages and messages[-1].ts < cutoff:
+        messages.pop()
+    return before - len(messages)
 
 # ================= CAPCODES =================
 
+_TRAUMA_RE = re.compile(r"trauma|heli|lifeliner|mmt", re.IGNORECASE)
+
+# Service keyword -> CSS class, matched in a single regex pass over "dienst".
+# Earlier entries win when several keywords occur in the same text.
+_DIENST_CSS = {
+    "brandweer": "dienst-brandweer",
+    "ambulance": "dienst-ambulance",
+    "rav": "dienst-ambulance",
+    "ghor": "dienst-ambulance",
+    "politie": "dienst-politie",
+    "kmar": "dienst-politie",
+}
+_DIENST_RANK = {k: i for i, k in enumerate(_DIENST_CSS)}
+_DIENST_RE = re.compile("|".join(_DIENST_CSS), re.IGNORECASE)
+
+def dienst_css(dienst: str, eenheid: str) -> str:
+    """Return the CSS class used to colour a capcode's service."""
+    if _TRAUMA_RE.search(eenheid):
+        return "dienst-trauma"
+    found = (k.lower() for k in _DIENST_RE.findall(dienst))
+    best = min(found, key=_DIENST_RANK.__getitem__, default=None)
+    return _DIENST_CSS[best] if best else "dienst-onbekend"
+
 def load_capcodes() -> None:
     """Load capcode database from CSV file."""
     if not CAPCODE_FILE.exists():
@@ -94,84 +182,193 @@ def load_capcodes() -> None:
         return
     
     try:
-        with open(CAPCODE_FILE, encoding="utf-8") as f:
-            reader = csv.reader(f, delimiter=";", quotechar='"')
-            for r in reader:
-                if len(r) < 5:
-                    continue
-                capcodes[r[0].zfill(7)] = {
-                    "dienst": r[1],
-                    "provincie": r[2],
-                    "regio": r[3],
-                    "eenheid": r[4],
-                }
+        # One read for the whole file, then split it in memory
+        data = CAPCODE_FILE.read_text(encoding="utf-8")
+        for line in data.split("\n"):
+            # Plain ';'-separated fields, each wrapped in double quotes
+            r = [field.strip('"') for field in line.rstrip("\r").split(";")]
+            if len(r) < 5:
+                continue
+            key = r[0].zfill(7)
+            info = {
+                "capcode": key,
+                "dienst": r[1],
+                "provincie": r[2],
+                "regio": r[3],
+                "eenheid": r[4],
+                # Classified once here instead of for every message
+                "css": dienst_css(r[1], r[4]),
+            }
+            info["html"] = (
+                f"<span class='{info['css']}'>{key} – {r[1]} | {r[4]} ({r[3]})</span>"
+            )
+            capcodes[key] = info
+        # Cached output was built from the previous capcode list
+        resolve_capcodes.cache_clear()
         logger.info(f"Capcodes geladen: {len(capcodes)}")
     except Exception as e:
         logger.error(f"Error loading capcodes: {e}", exc_info=True)
 
+@lru_cache(maxsize=4096)
 def resolve_capcodes(raw: str) -> str:
+    """Render the capcodes of a message as HTML; the same units recur a lot."""
     out = []
     for t in raw.split():
-        info, used = None, None
-        for cc in capcode_candidates(t):
-            if cc in capcodes:
-                info, used = capcodes[cc], cc
-                break
+        # Long capcodes carry a prefix; the last 7 digits identify the unit
+        key = t[-7:] if len(t) >= 9 and t.isdigit() else t
+        info = capcodes.get(key)
 
         if info:
-            d = info["dienst"].lower()
-            e = info["eenheid"].lower()
-            if any(x in e for x in ("trauma", "heli", "lifeliner", "mmt")):
-                css = "dienst-trauma"
-            elif "brandweer" in d:
-                css = "dienst-brandweer"
-            elif "ambulance" in d or "rav" in d or "ghor" in d:
-                css = "dienst-ambulance"
-            elif "politie" in d or "kmar" in d:
-                css = "dienst-politie"
-            else:
-                css = "dienst-onbekend"
-
-            out.append(
-                f"<span class='{css}'>{used} – {info['dienst']} | {info['eenheid']} ({info['regio']})</span>"
-            )
+            out.append(info["html"])
         else:
             out.append(f"<span class='dienst-onbekend'>{t} – Onbekend</span>")
     return "<br>".join(out)
 
+def render_message(m: Message) -> Dict[str, Any]:
+    """Return the message as sent to the browser, with capcodes as HTML.
+
+    Messages only store the raw capcodes; the HTML is built when a message
+    is actually shown. Entries from older history files already have it.
+    """
+    d = m._asdict()
+    if m.capcodes_named is None:
+        d["capcodes_named"] = resolve_capcodes(m.caps_raw)
+    return d
+
 # ================= HISTORY =================
+#
+# History is stored as JSON lines, oldest message first. New messages are
+# appended; the file is only rewritten (compacted) once enough messages have
+# expired. Loading skips the stale lines, so they only cost disk space.
+
+def _mark_stale(n: int) -> None:
+    global history_stale
+    history_stale += n
+    if history_stale >= HISTORY_COMPACT_LINES:
+        history_dirty.set()
 
 def load_history() -> None:
-    """Load message history from JSON file."""
-    if not DB_FILE.exists():
-        logger.info("No history file found, starting fresh")
-        return
-    
+    """Load message history from the JSONL file (or the legacy JSON file)."""
+    migrated = False
+    lines = 0
     try:
-        with open(DB_FILE, encoding="utf-8") as f:
-            data = json.load(f)
-            for m in data:
-                m.setdefault("prio", extract_prio(m.get("text", "")))
-                messages.append(m)
+        if DB_FILE.exists():
+            loaded = []
+            with open(DB_FILE, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    lines += 1
+                    try:
+                        loaded.append(json.loads(line))
+                    except ValueError:
+                        # e.g. a partial line left behind by a crash
+                        logger.warning(f"Skipping corrupt history line: {line[:50]}...")
+            loaded.reverse()  # the file is oldest first
+        elif LEGACY_DB_FILE.exists():
+            logger.info(f"Migrating history from {LEGACY_DB_FILE.name}")
+            with open(LEGACY_DB_FILE, encoding="utf-8") as f:
+                loaded = json.load(f)
+            migrated = True
+        else:
+            logger.info("No history file found, starting fresh")
+            return
+
+        entries = []
+        for d in loaded:
+            try:
+                entries.append(Message.from_dict(d))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping invalid history entry: {e!r}")
+        # Pruning only looks at the tail, so the order must be newest first.
+        # The data is normally sorted already, which makes this linear.
+        entries.sort(key=lambda m: m.ts, reverse=True)
+        if len(entries) > MAX_MESSAGES:
+            # extend() on a full deque would drop the newest messages instead
+            del entries[MAX_MESSAGES:]
+        messages.extend(entries)
         prune_old_messages()
+        if not migrated:
+            _mark_stale(lines - len(messages))
         logger.info(f"Loaded {len(messages)} messages from history")
     except Exception as e:
         logger.error(f"Error loading history: {e}", exc_info=True)
+        return
+
+    if migrated:
+        # Write the JSONL file right away: once it exists the legacy file is
+        # never read again, so the first appended message must not create it
+        try:
+            _replace_file(_encode_history())
+            logger.info(f"History migrated to {DB_FILE.name}")
+        except Exception as e:
+            logger.error(f"Error writing migrated history: {e}", exc_info=True)
+            history_dirty.set()
+
+def _append_line(line: bytes) -> None:
+    with open(DB_FILE, "ab") as f:
+        f.write(line + b"\n")
+
+def _encode_history() -> bytes:
+    # Oldest first, one JSON document per line
+    return b"".join(_encode_json_bytes(m.to_dict()) + b"\n" for m in reversed(messages))
+
+def _replace_file(data: bytes) -> None:
+    # Write to a temp file first so a crash never leaves a truncated history
+    tmp = DB_FILE.with_suffix(".jsonl.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, DB_FILE)
+
+async def add_message(e: Message) -> None:
+    """Add a new message to memory and append it to the history file."""
+    async with history_lock:
+        if len(messages) == messages.maxlen:
+            # The oldest message falls off but stays in the file for now
+            _mark_stale(1)
+        messages.appendleft(e)
+        try:
+            line = _encode_json_bytes(e.to_dict())
+            await asyncio.to_thread(_append_line, line)
+        except Exception as ex:
+            logger.error(f"Error appending history: {ex}", exc_info=True)
+            # The message is only in memory now; rewrite the file from there
+            history_dirty.set()
 
 async def save_history_async() -> None:
-    """Save message history to JSON file asynchronously."""
+    """Rewrite the history file from the messages in memory."""
+    global history_stale
     try:
-        # avoid blocking event loop on file IO
-        data = json.dumps(messages, indent=2, ensure_ascii=False)
-        await asyncio.to_thread(DB_FILE.write_text, data, encoding="utf-8")
+        async with history_lock:
+            data = _encode_history()
+            # Messages that expire from here on are still in the new file
+            history_stale = 0
+            # avoid blocking event loop on file IO
+            await asyncio.to_thread(_replace_file, data)
     except Exception as e:
         logger.error(f"Error saving history: {e}", exc_info=True)
+        # Retry on the next flush, or at shutdown
+        history_dirty.set()
+
+async def history_flusher() -> None:
+    """Compact the history file in the background once enough messages expired."""
+    while True:
+        await history_dirty.wait()
+        # Let expiries accumulate so they cost a single rewrite
+        await asyncio.sleep(HISTORY_SAVE_INTERVAL)
+        history_dirty.clear()
+        await save_history_async()
 
 # ================= WEBSOCKET =================
 
 async def ws_handler(ws: websockets.WebSocketServerProtocol) -> None:
     """Handle WebSocket client connection."""
-    clients.add(ws)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+    writer = asyncio.create_task(client_writer(ws, queue))
+    clients[ws] = (queue, writer)
+    # Drop the client as soon as its writer stops, even if this handler is
+    # still waiting for the close handshake
+    writer.add_done_callback(lambda _: clients.pop(ws, None))
     logger.debug(f"WebSocket client connected. Total clients: {len(clients)}")
     try:
         # Keep connection open; browser doesn't send data.
@@ -182,24 +379,36 @@ async def ws_handler(ws: websockets.WebSocketServerProtocol) -> None:
     except Exception as e:
         logger.error(f"WebSocket error: {e}", exc_info=True)
     finally:
-        clients.discard(ws)
+        clients.pop(ws, None)
+        writer.cancel()
         logger.debug(f"WebSocket client removed. Total clients: {len(clients)}")
 
-async def broadcast(msg: str) -> None:
-    """Broadcast message to all connected WebSocket clients."""
-    if not clients:
-        return
-    dead = []
-    for ws in list(clients):
+async def client_writer(ws: websockets.WebSocketServerProtocol, queue: asyncio.Queue) -> None:
+    """Send queued broadcasts to one client until it disconnects or is dropped."""
+    try:
+        while True:
+            await ws.send(await queue.get())
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    except Exception as e:
+        logger.debug(f"Error sending to WebSocket client: {e}")
+    finally:
+        # Also runs when cancelled, e.g. by broadcast() while stuck in send().
+        # close() gives up after the close timeout; nobody awaits this task.
+        with contextlib.suppress(Exception):
+            await ws.close()
+
+def broadcast(msg: bytes) -> None:
+    """Queue message for all connected WebSocket clients without waiting on them."""
+    for ws, (queue, writer) in list(clients.items()):
         try:
-            await ws.send(msg)
-        except websockets.exceptions.ConnectionClosed:
-            dead.append(ws)
-        except Exception as e:
-            logger.debug(f"Error sending to WebSocket client: {e}")
-            dead.append(ws)
-    for ws in dead:
-        clients.discard(ws)
+            queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            logger.warning("WebSocket client is not keeping up, disconnecting")
+            del clients[ws]
+            # Its writer is probably blocked in send() and would never get to
+            # a queued close request; cancelling it closes the connection
+            writer.cancel()
 
 async def ws_server() -> None:
     """Start WebSocket server."""
@@ -209,86 +418,149 @@ async def ws_server() -> None:
 
 # ================= DECODER =================
 
+async def process_line(line: bytes) -> None:
+    """Turn one line of multimon-ng output into a stored and broadcast message."""
+    # Most output is status/noise; only decode the lines we keep
+    if not line.startswith(b"FLEX|"):
+        return
+    l = line.decode("utf-8", errors="ignore").strip()
+
+    try:
+        _, ts, *_, caps, typ, txt = l.split("|", 6)
+    except ValueError as e:
+        logger.debug(f"Failed to parse decoder line: {l[:50]}... Error: {e}")
+        return
+
+    received = time.time()
+    e = Message(
+        time_local=ts,
+        time_utc=datetime.fromtimestamp(received, timezone.utc).isoformat(),
+        ts=received,
+        prio=extract_prio(txt),
+        type=typ,
+        text=txt,
+        caps_raw=caps,
+    )
+
+    await add_message(e)
+    _mark_stale(prune_old_messages(received))
+    
+    # Encoded once here; every client is sent the same bytes. Without
+    # viewers there is nothing to render or encode at all.
+    if clients:
+        broadcast(_encode_json_bytes(render_message(e)))
+
 async def start_decoder() -> None:
-    """Start the RTL-SDR decoder subprocess and process messages."""
-    cmd = "rtl_fm -f 169.65M -M fm -s 22050 -p 83 -g 30 | multimon-ng -a FLEX -t raw -"
+    """Start the rtl_fm | multimon-ng subprocesses and process messages."""
+    rtl: Optional[asyncio.subprocess.Process] = None
     proc: Optional[asyncio.subprocess.Process] = None
     
     try:
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        # Wire rtl_fm into multimon-ng directly instead of via a /bin/sh pipeline
+        read_fd, write_fd = os.pipe()
+        try:
+            rtl = await asyncio.create_subprocess_exec(
+                *RTL_FM_CMD,
+                stdout=write_fd,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            proc = await asyncio.create_subprocess_exec(
+                *MULTIMON_CMD,
+                stdin=read_fd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+                limit=DECODER_READ_LIMIT,
+            )
+        finally:
+            # The child processes hold their own copies of the pipe ends
+            os.close(read_fd)
+            os.close(write_fd)
         if proc.stdout is None:
             logger.error("Decoder process stdout is None")
             return
         
         logger.info("Decoder started")
-        last_save_time = datetime.now(timezone.utc)
 
+        # Read whatever is buffered and split it ourselves; a burst of lines
+        # then costs one read instead of one readline() per line
+        buf = b""
         while not shutdown_event.is_set():
-            line = await proc.stdout.readline()
-            if not line:
+            chunk = await proc.stdout.read(DECODER_READ_LIMIT)
+            if not chunk:
+                if buf:
+                    await process_line(buf)
                 logger.warning("Decoder process ended")
                 break
 
-            l = line.decode(errors="ignore").strip()
-            if not l.startswith("FLEX|"):
-                continue
-
-            try:
-                _, ts, *_, caps, typ, txt = l.split("|", 6)
-            except ValueError as e:
-                logger.debug(f"Failed to parse decoder line: {l[:50]}... Error: {e}")
-                continue
-
-            e = {
-                "time_local": ts,
-                "time_utc": datetime.now(timezone.utc).isoformat(),
-                "prio": extract_prio(txt),
-                "capcodes_named": resolve_capcodes(caps),
-                "type": typ,
-                "text": txt,
-            }
-
-            messages.insert(0, e)
-            prune_old_messages()
-            
-            # Save history periodically instead of on every message
-            now = datetime.now(timezone.utc)
-            if (now - last_save_time).total_seconds() >= HISTORY_SAVE_INTERVAL:
-                await save_history_async()
-                last_save_time = now
-            
-            await broadcast(json.dumps(e, ensure_ascii=False))
+            *lines, buf = (buf + chunk).split(b"\n")
+            for line in lines:
+                await process_line(line)
             
     except Exception as e:
         logger.error(f"Decoder error: {e}", exc_info=True)
     finally:
-        if proc:
+        # Stop the consumer first, then the SDR feeding it
+        for p in (proc, rtl):
+            if not p or p.returncode is not None:
+                continue
             try:
-                proc.terminate()
-                await asyncio.wait_for(proc.wait(), timeout=5.0)
+                p.terminate()
+                await asyncio.wait_for(p.wait(), timeout=5.0)
             except asyncio.TimeoutError:
-                logger.warning("Decoder process did not terminate, killing")
-                proc.kill()
-                await proc.wait()
+                logger.warning(f"Decoder process {p.pid} did not terminate, killing")
+                p.kill()
+                await p.wait()
             except Exception as e:
-                logger.error(f"Error terminating decoder: {e}")
+                logger.error(f"Error terminating decoder process {p.pid}: {e}")
 
 # ================= HTTP =================
 
 async def http_index(request: web.Request) -> web.Response:
     """Handle HTTP index page request."""
-    html = page()
     # aiohttp requires charset to be separate from content_type
-    return web.Response(text=html, content_type="text/html", charset="utf-8")
-
-def page() -> str:
-    """Generate HTML page with embedded JavaScript."""
-    # Escape JSON to prevent XSS
-    messages_json = json.dumps(messages, ensure_ascii=False).replace("</script>", "<\\/script>")
+    resp = web.Response(
+        body=page(),
+        content_type="text/html",
+        charset="utf-8",
+        headers={"Cache-Control": "no-store"},  # the inlined messages are live data
+    )
+    resp.enable_compression()
+    return resp
+
+async def http_history(request: web.Request) -> web.Response:
+    """Return the page of messages older than ?before=<epoch seconds>."""
+    try:
+        before = float(request.query["before"])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text="Query parameter 'before' must be an epoch timestamp")
+    # Messages are ordered newest first
+    older = itertools.dropwhile(lambda m: m.ts >= before, messages)
+    return web.json_response(
+        [render_message(m) for m in itertools.islice(older, HISTORY_PAGE_SIZE)],
+        dumps=_encode_json
+    )
+
+# Inlined messages JSON, reused until a message is added or removed
+_page_json = b""
+_page_json_key: Optional[tuple] = None
+
+def page() -> bytes:
+    """Generate HTML page: the prebuilt shell around the newest messages."""
+    global _page_json, _page_json_key
+    # New messages change the head, pruning changes the length
+    key = (len(messages), messages[0].ts if messages else None)
+    if key != _page_json_key:
+        # Only the newest messages are inlined; older ones are fetched on scroll
+        newest = [render_message(m) for m in itertools.islice(messages, HISTORY_PAGE_SIZE)]
+        # Escape JSON to prevent XSS
+        _page_json = _encode_json_bytes(newest).replace(b"</script>", b"<\\/script>")
+        _page_json_key = key
+    return _PAGE_HEAD + _page_json + _PAGE_TAIL
+
+_INITIAL_PLACEHOLDER = "__INITIAL_MESSAGES__"
+
+def page_template() -> str:
+    """Return the static HTML/CSS/JS page with a placeholder for the messages."""
     return f"""
 <!DOCTYPE html>
 <html lang="nl">
@@ -655,6 +927,10 @@ mark {{
   transform: translateY(0);
 }}
 
+#loadMore {{
+  height: 1px;
+}}
+
 .map-button:disabled {{
   opacity: 0.4;
   cursor: not-allowed;
@@ -707,18 +983,20 @@ mark {{
       </thead>
       <tbody></tbody>
     </table>
+    <div id="loadMore"></div>
   </div>
 </div>
 
 <script>
 const table = document.getElementById("tbl");
 const tbody = table.querySelector("tbody");
-const INITIAL = {messages_json};
+const INITIAL = {_INITIAL_PLACEHOLDER};
 let filter = "ALL";
 let searchQuery = "";
 
-function isRecent(utc) {{
-  return (Date.now() - new Date(utc).getTime()) <= 5 * 60 * 1000;
+// ts is epoch seconds from the server, so no date string parsing is needed
+function isRecent(ts) {{
+  return (Date.now() - ts * 1000) <= 5 * 60 * 1000;
 }}
 
 function matchSearch(m) {{
@@ -821,14 +1099,14 @@ function getMapUrl(text) {{
 
 function renderRow(m, isNew = false) {{
   const r = document.createElement("tr");
-  r.dataset.utc = m.time_utc;
+  r.dataset.ts = m.ts;
   if (isNew) {{
     r.classList.add("new-message");
     setTimeout(() => r.classList.remove("new-message"), 2000);
   }}
   
   const prioClass = getPrioClass(m.prio);
-  const recentIcon = isRecent(m.time_utc) ? "🔔 " : "";
+  const recentIcon = isRecent(m.ts) ? "🔔 " : "";
   const mapUrl = getMapUrl(m.text);
   
   const mapButton = mapUrl 
@@ -900,11 +1178,45 @@ btnBeemster.onclick = () => {{
 // Initial render
 INITIAL
   .slice()
-  .sort((a,b) => new Date(b.time_utc) - new Date(a.time_utc))
+  .sort((a,b) => b.ts - a.ts)
   .forEach(m => tbody.appendChild(renderRow(m)));
 
+// Load older messages when the bottom of the table scrolls into view
+const loadMore = document.getElementById("loadMore");
+let loadingOlder = false;
+let historyDone = INITIAL.length < {HISTORY_PAGE_SIZE};
+
+async function loadOlder() {{
+  if (loadingOlder || historyDone || !INITIAL.length) return;
+  loadingOlder = true;
+  try {{
+    const oldest = INITIAL[INITIAL.length - 1].ts;
+    const res = await fetch(`/history?before=${{oldest}}`);
+    const older = await res.json();
+    if (older.length < {HISTORY_PAGE_SIZE}) historyDone = true;
+    older.forEach(m => {{
+      INITIAL.push(m);
+      if (matchFilter(m)) tbody.appendChild(renderRow(m));
+    }});
+  }} catch (err) {{
+    console.error("Failed to load older messages:", err);
+    return;
+  }} finally {{
+    loadingOlder = false;
+  }}
+  // Keep going while the bottom is still visible (e.g. a filter hid the new rows)
+  if (loadMore.getBoundingClientRect().top <= window.innerHeight) loadOlder();
+}}
+
+new IntersectionObserver(entries => {{
+  if (entries.some(e => e.isIntersecting)) loadOlder();
+}}).observe(loadMore);
+
 // WebSocket connection
 const ws = new WebSocket("ws://" + location.hostname + ":{WS_PORT}");
+// Messages arrive as UTF-8 encoded JSON in binary frames
+ws.binaryType = "arraybuffer";
+const utf8 = new TextDecoder();
 
 ws.onopen = () => {{
   console.log("WebSocket connected");
@@ -919,7 +1231,7 @@ ws.onclose = () => {{
 }};
 
 ws.onmessage = e => {{
-  const m = JSON.parse(e.data);
+  const m = JSON.parse(utf8.decode(e.data));
   INITIAL.unshift(m);
   if (matchFilter(m)) {{
     const newRow = renderRow(m, true);
@@ -930,10 +1242,10 @@ ws.onmessage = e => {{
 // Update recent indicators every 30 seconds
 setInterval(() => {{
   [...tbody.rows].forEach(row => {{
-    const utc = row.dataset.utc;
+    const ts = Number(row.dataset.ts);
     const cell = row.cells[0];
     const text = cell.textContent.replace("🔔 ", "");
-    cell.textContent = (isRecent(utc) ? "🔔 " : "") + text;
+    cell.textContent = (isRecent(ts) ? "🔔 " : "") + text;
   }});
 }}, 30000);
 
@@ -952,10 +1264,14 @@ setInterval(updateClock, 1000);
 </html>
 """
 
+# The page shell never changes, so render and encode it once at startup
+_PAGE_HEAD, _PAGE_TAIL = (part.encode("utf-8") for part in page_template().split(_INITIAL_PLACEHOLDER))
+
 async def http_server() -> None:
     """Start HTTP server."""
     app = web.Application()
     app.router.add_get("/", http_index)
+    app.router.add_get("/history", http_history)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "", HTTP_PORT)
@@ -979,10 +1295,12 @@ def setup_signal_handlers() -> None:
 async def main() -> None:
     """Main entry point."""
     setup_signal_handlers()
+    flusher: Optional[asyncio.Task] = None
     
     try:
         load_capcodes()
         load_history()
+        flusher = asyncio.create_task(history_flusher())
 
         # Start all services
         await asyncio.gather(
@@ -994,14 +1312,27 @@ async def main() -> None:
     except Exception as e:
         logger.error(f"Fatal error: {e}", exc_info=True)
     finally:
-        # Final save on shutdown
-        logger.info("Saving history before shutdown...")
-        await save_history_async()
+        if flusher:
+            flusher.cancel()
+        # New messages are appended as they arrive; only a pending
+        # compaction still has to be written
+        if history_dirty.is_set():
+            logger.info("Saving history before shutdown...")
+            await save_history_async()
         logger.info("Shutdown complete")
 
 if __name__ == "__main__":
+    run = asyncio.run
+    try:
+        import uvloop  # optional, faster event loop
+        # uvloop.run() instead of install(), which is deprecated on 3.12+
+        run = uvloop.run
+        logger.debug("Using uvloop event loop")
+    except (ImportError, AttributeError):
+        pass  # not installed, or older than 0.18 without run()
+
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.info("Interrupted by user")
 